@@ -6,6 +6,7 @@ import PDFDocument from 'pdfkit';
  *  - FILEVINE_CLIENT_SECRET
  *  - FILEVINE_PAT_TOKEN
  *  - DEBUG (optional: "true" | "false"; default "true")
+ *  - COMMENTS_CONCURRENCY (optional: parallel comment fetches; default 4)
  *
  * API gateway (global): https://api.filevineapp.com/fv-app/v2
  * Notes/comments are not project-scoped in v2; use /notes/{noteId}/comments.
@@ -15,6 +16,7 @@ const IDENTITY_URL = 'https://identity.filevine.com/connect/token';
 const GATEWAY_UTILS_BASE  = 'https://api.filevineapp.com/fv-app/v2';
 const GATEWAY_REGION_BASE = 'https://api.filevineapp.com/fv-app/v2';
 const DEBUG = (process.env.DEBUG ?? 'true').toLowerCase() !== 'false';
+const COMMENTS_CONCURRENCY = Math.max(1, parseInt(process.env.COMMENTS_CONCURRENCY ?? '', 10) || 4);
 
 const REQ = () => Math.random().toString(36).slice(2, 10);
 const dlog = (...args) => { if (DEBUG) console.log('[debug]', ...args); };
@@ -195,11 +197,8 @@ export default async function handler(req, res) {
       projectId
     });
 
-    // 1) Token
-    const token = await getBearerToken(reqId);
-
-    // 2) Resolve user/org (ensure **numeric strings**)
-    const { userId, orgId } = await getUserAndOrgIds(token, reqId);
+    // 1) Token + 2) resolve user/org (ensure **numeric strings**)
+    const { token, userId, orgId } = await getSession(reqId);
     dlog(`[${reqId}] Using gateway headers`, { 'x-fv-userid': userId, 'x-fv-orgid': orgId });
 
     // 3) Pull notes & emails
@@ -257,7 +256,10 @@ export default async function handler(req, res) {
           body: e?.body || e?.content || e?.text || ''
         };
       })
-    ].sort((a, b) => new Date(a.created || 0) - new Date(b.created || 0));
+    ];
+    // Parse each timestamp once instead of twice per comparison
+    const createdMs = new Map(merged.map((m) => [m, new Date(m.created || 0).getTime()]));
+    merged.sort((a, b) => createdMs.get(a) - createdMs.get(b));
 
     dlog(`[${reqId}] Merge complete`, { mergedCount: merged.length });
 
@@ -467,16 +469,12 @@ function debugNoteAuthorFields(notes, reqId) {
   dlog(`[${reqId}] First note author debug`, snapshot);
 }
 
+const DATE_KEY_RE = /date|time|created|received|sent/i;
+
 function debugDateFields(items, type, reqId) {
   if (items.length > 0) {
     const sample = items[0];
-    const dateFields = Object.keys(sample).filter(key =>
-      key.toLowerCase().includes('date') ||
-      key.toLowerCase().includes('time') ||
-      key.toLowerCase().includes('created') ||
-      key.toLowerCase().includes('received') ||
-      key.toLowerCase().includes('sent')
-    );
+    const dateFields = Object.keys(sample).filter(key => DATE_KEY_RE.test(key));
 
     dlog(`[${reqId}] ${type} sample date fields:`, {
       availableFields: dateFields,
@@ -489,23 +487,25 @@ function debugDateFields(items, type, reqId) {
   }
 }
 
+const NOTE_DATE_FIELDS = [
+  'createdDate','created','date','dateCreated','createDate',
+  'timestamp','createdAt','dateTime','noteDate','updatedDate'
+];
+const EMAIL_DATE_FIELDS = [
+  'dateReceived','dateSent','createdDate','created','date',
+  'dateCreated','createDate','timestamp','createdAt','dateTime',
+  'receivedDate','sentDate','emailDate','updatedDate'
+];
+const COMMENT_DATE_FIELDS = [
+  'createdDate','created','date','dateCreated','createDate',
+  'timestamp','createdAt','dateTime','commentDate','updatedDate'
+];
+
 function extractDate(item, type) {
   const dateFields =
-    type === 'note'
-      ? [
-          'createdDate','created','date','dateCreated','createDate',
-          'timestamp','createdAt','dateTime','noteDate','updatedDate'
-        ]
-      : type === 'email'
-      ? [
-          'dateReceived','dateSent','createdDate','created','date',
-          'dateCreated','createDate','timestamp','createdAt','dateTime',
-          'receivedDate','sentDate','emailDate','updatedDate'
-        ]
-      : [
-          'createdDate','created','date','dateCreated','createDate',
-          'timestamp','createdAt','dateTime','commentDate','updatedDate'
-        ];
+    type === 'note' ? NOTE_DATE_FIELDS
+    : type === 'email' ? EMAIL_DATE_FIELDS
+    : COMMENT_DATE_FIELDS;
 
   for (const field of dateFields) {
     const value = item?.[field];
@@ -518,6 +518,15 @@ function extractDate(item, type) {
   return new Date().toISOString();
 }
 
+const DATE_FORMAT = new Intl.DateTimeFormat('en-US', {
+  year: 'numeric',
+  month: '2-digit',
+  day: '2-digit',
+  hour: '2-digit',
+  minute: '2-digit',
+  hour12: false
+});
+
 function fmt(d) {
   if (!d) return 'No Date';
   try {
@@ -526,14 +535,7 @@ function fmt(d) {
       console.warn('Invalid date value:', d);
       return 'Invalid Date';
     }
-    return date.toLocaleString('en-US', {
-      year: 'numeric',
-      month: '2-digit',
-      day: '2-digit',
-      hour: '2-digit',
-      minute: '2-digit',
-      hour12: false
-    });
+    return DATE_FORMAT.format(date);
   } catch (err) {
     console.warn('Date formatting error:', err.message, 'for value:', d);
     return 'Date Error';
@@ -542,15 +544,29 @@ function fmt(d) {
 
 function stripHtml(html) {
   if (!html) return '';
-  return String(html)
-    .replace(/<style[^>]*>[\s\S]*?<\/style>/gi, '')
-    .replace(/<script[^>]*>[\s\S]*?<\/script>/gi, '')
-    .replace(/<[^>]*>/g, '')
-    .replace(/\s+\n/g, '\n')
+  const text = String(html);
+  // Plain-text bodies have no tags; skip the three tag passes entirely
+  const untagged = text.includes('<')
+    ? text
+        .replace(/<style[^>]*>[\s\S]*?<\/style>/gi, '')
+        .replace(/<script[^>]*>[\s\S]*?<\/script>/gi, '')
+        .replace(/<[^>]*>/g, '')
+    : text;
+  return untagged
+    .replace(/\s+/g, collapseToLastNewline)
     .replace(/[ \t]+/g, ' ')
     .trim();
 }
 
+/**
+ * Same result as `.replace(/\s+\n/g, '\n')` without its quadratic
+ * backtracking on long whitespace runs that contain no newline.
+ */
+function collapseToLastNewline(ws) {
+  const i = ws.lastIndexOf('\n');
+  return i <= 0 ? ws : '\n' + ws.slice(i + 1);
+}
+
 function toAbsoluteUrl(pathOrUrl) {
   try {
     return new URL(pathOrUrl, GATEWAY_REGION_BASE).toString();
@@ -559,7 +575,16 @@ function toAbsoluteUrl(pathOrUrl) {
   }
 }
 
+// Reused across warm invocations of the same function instance.
+let cachedToken = null; // { value, expiresAt }
+const TOKEN_EXPIRY_SKEW_MS = 60_000;
+
 async function getBearerToken(reqId) {
+  if (cachedToken && Date.now() < cachedToken.expiresAt) {
+    dlog(`[${reqId}] Reusing cached token`, { expiresInMs: cachedToken.expiresAt - Date.now() });
+    return { token: cachedToken.value, fromCache: true };
+  }
+
   const client_id = process.env.FILEVINE_CLIENT_ID;
   const client_secret = process.env.FILEVINE_CLIENT_SECRET;
   const pat_token = process.env.FILEVINE_PAT_TOKEN;
@@ -586,7 +611,34 @@ async function getBearerToken(reqId) {
   const data = await safeJson(resp, reqId, 'identity');
   if (!data.access_token) throw new Error('No access_token in identity response');
   dlog(`[${reqId}] Token acquired (length)`, { accessTokenLength: String(data.access_token).length });
-  return data.access_token;
+
+  const ttlMs = Number(data.expires_in) * 1000 - TOKEN_EXPIRY_SKEW_MS;
+  cachedToken = ttlMs > 0 ? { value: data.access_token, expiresAt: Date.now() + ttlMs } : null;
+  return { token: data.access_token, fromCache: false };
+}
+
+/** Drop the cached token once the gateway rejects it, so the next exchange is fresh. */
+function invalidateTokenOnAuthFailure(resp, reqId) {
+  if (resp.status !== 401 || !cachedToken) return;
+  dlog(`[${reqId}] Gateway returned 401; clearing cached token`);
+  cachedToken = null;
+}
+
+/**
+ * Token plus user/org IDs. A cached token can be revoked before it expires
+ * (e.g. PAT rotation), so a 401 on a cached token gets one fresh exchange.
+ */
+async function getSession(reqId) {
+  const { token, fromCache } = await getBearerToken(reqId);
+  try {
+    return { token, ...(await getUserAndOrgIds(token, reqId)) };
+  } catch (err) {
+    if (!fromCache || err?.status !== 401) throw err;
+    dlog(`[${reqId}] Cached token rejected; retrying with a fresh token`);
+    cachedToken = null;
+    const fresh = await getBearerToken(reqId);
+    return { token: fresh.token, ...(await getUserAndOrgIds(fresh.token, reqId)) };
+  }
 }
 
 async function getUserAndOrgIds(bearer, reqId) {
@@ -599,7 +651,9 @@ async function getUserAndOrgIds(bearer, reqId) {
   dlog(`[${reqId}] GetUserOrgsWithToken response`, { status: resp.status });
   if (!resp.ok) {
     await logErrorBody(resp, reqId, 'GetUserOrgsWithToken');
-    throw new Error(`GetUserOrgsWithToken error: ${resp.status}`);
+    const err = new Error(`GetUserOrgsWithToken error: ${resp.status}`);
+    err.status = resp.status;
+    throw err;
   }
   const data = await safeJson(resp, reqId, 'getUserOrgsWithToken');
 
@@ -763,6 +817,7 @@ async function fetchWithRetry(input, init = {}, reqId, retries = 2, delayMs = 25
     attempt++;
     try {
       const resp = await fetch(input, init);
+      invalidateTokenOnAuthFailure(resp, reqId);
       if (resp.status >= 500 && retries > 0) {
         dlog(`[${reqId}] fetchWithRetry 5xx`, { url: input, status: resp.status, attempt });
         await sleep(delayMs * attempt);
@@ -799,10 +854,10 @@ async function safeJson(resp, reqId, tag) {
   }
 }
 
+/** Consumes the body; callers only use this right before throwing. */
 async function logErrorBody(resp, reqId, tag) {
   try {
-    const clone = resp.clone?.() ?? resp;
-    const text = await clone.text();
+    const text = await resp.text();
     dlog(`[${reqId}] ${tag} error body`, { snippet: text.slice(0, 600) });
   } catch (err) {
     dlog(`[${reqId}] ${tag} error body read failed`, { message: err?.message });
@@ -815,7 +870,8 @@ function previewJson(obj, maxKeys = 20) {
   const preview = {};
   for (const k of keys) {
     const v = obj[k];
-    preview[k] = (k.toLowerCase().includes('token') || k.toLowerCase().includes('secret'))
+    const lk = k.toLowerCase();
+    preview[k] = (lk.includes('token') || lk.includes('secret'))
       ? '[redacted]'
       : summarize(v);
   }
@@ -844,18 +900,7 @@ function extractEmbeddedComments(note) {
     note?.page?.items
   ];
   const found = arrays.find(a => Array.isArray(a)) || [];
-  return found.map(c => {
-    const id = authorIdFromComment(c);
-    const mapped = nameFromMap(id);
-    const authorName = mapped || extractAuthor(c);
-    return ({
-      id: normalizeId(c?.id ?? c?.commentId),
-      created: extractDate(c, 'comment'),
-      author: authorName,
-      body: c?.body || c?.text || c?.content || '',
-      __authorId: id ?? null
-    });
-  });
+  return normalizeComments(found);
 }
 
 function commentsLinkFromNote(note) {
@@ -871,9 +916,10 @@ function commentsLinkFromNote(note) {
 async function attachCommentsToNotes({ notes, projectId, token, userId, orgId, reqId }) {
   if (!Array.isArray(notes) || !notes.length) return [];
 
-  dlog(`[${reqId}] Attaching comments to ${notes.length} notes`);
-  const MAX_CONCURRENCY = 4;
-  const queue = notes.slice();
+  // Comments are attached in place: each note is a fresh JSON-parsed object
+  dlog(`[${reqId}] Attaching comments to ${notes.length} notes`, { concurrency: COMMENTS_CONCURRENCY });
+  const MAX_CONCURRENCY = COMMENTS_CONCURRENCY;
+  const queue = notes.map(n => (n && typeof n === 'object') ? n : {});
   const results = [];
   let active = 0;
 
@@ -888,10 +934,10 @@ async function attachCommentsToNotes({ notes, projectId, token, userId, orgId, r
             const noteId = normalizeId(note?.id ?? note?.noteId);
             const pre = extractEmbeddedComments(note);
             if (pre.length) {
-              results.push({ ...note, comments: pre });
+              note.comments = pre;
             } else if (!noteId) {
               dlog(`[${reqId}] No usable noteId; skipping comment fetch`);
-              results.push({ ...note, comments: [] });
+              note.comments = [];
             } else {
               const link = commentsLinkFromNote(note);
               const comments = await getNoteComments({
@@ -903,12 +949,13 @@ async function attachCommentsToNotes({ notes, projectId, token, userId, orgId, r
                 orgId,
                 reqId
               });
-              results.push({ ...note, comments });
+              note.comments = comments;
             }
           } catch (err) {
             dlog(`[${reqId}] comments fetch failed`, { error: err?.message });
-            results.push({ ...note, comments: [] });
+            note.comments = [];
           } finally {
+            results.push(note);
             active--;
             runNext();
           }